@@ -1,13 +1,21 @@
 import asyncio
+import functools
+import hashlib
+import hmac
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import Any, Dict, Optional, Tuple
 
-import anyio
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+import httpx
+import orjson
+from fastapi import Depends, FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import ValidationError
 
 from sheets import LeadData, SheetsClient
 from skillspace import invite_student, SkillspaceError
@@ -18,10 +26,19 @@ logger = logging.getLogger("procto")
 
 
 # ---------------- utils ----------------
+_iso_cache: Tuple[int, str] = (-1, "")
+
+
 def utc_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+    # second resolution; the string is rendered once per wall-clock second
+    global _iso_cache
+    t = int(time.time())
+    if t != _iso_cache[0]:
+        _iso_cache = (t, datetime.fromtimestamp(t, timezone.utc).isoformat())
+    return _iso_cache[1]
 
 
+@functools.lru_cache(maxsize=None)
 def must_env(name: str) -> str:
     v = os.getenv(name, "").strip()
     if not v:
@@ -37,30 +54,90 @@ def get_env_any(*names: str, default: str = "") -> str:
     return default
 
 
+@functools.lru_cache(maxsize=32)
 def extract_sheet_id(sheet_id_or_url: str) -> str:
     s = (sheet_id_or_url or "").strip()
-    if "docs.google.com" in s and "/d/" in s:
-        return s.split("/d/")[1].split("/")[0]
-    return s
+    if "/" not in s:
+        return s
+    # https://docs.google.com/spreadsheets/d/<ID>/edit -> <ID>; a bare ID has no "/d/"
+    _, sep, tail = s.partition("/d/")
+    return tail.partition("/")[0] if sep else s
+
+
+_MISSING = object()
+
+# Skillspace puts the event name in different places depending on the hook type
+_EVENT_KEYS = ("event", "type", "event_name", "name")
+_EVENT_NESTED_PATH = ("data", "event")
+# raw-body markers: no key match means there is no event name to extract
+_EVENT_KEY_MARKERS = tuple(f'"{k}"'.encode() for k in _EVENT_KEYS)
 
 
 def deep_get(d: Any, path: Tuple[str, ...]) -> Optional[Any]:
+    # payloads come from json, so an exact dict check is enough
     cur = d
     for key in path:
-        if not isinstance(cur, dict) or key not in cur:
+        if cur.__class__ is not dict:
+            return None
+        cur = cur.get(key, _MISSING)
+        if cur is _MISSING:
             return None
-        cur = cur[key]
     return cur
 
 
 def extract_skillspace_event(payload: Dict[str, Any]) -> str:
     # purely for logging
-    for k in ("event", "type", "event_name", "name"):
+    for k in _EVENT_KEYS:
         v = payload.get(k)
-        if isinstance(v, str) and v:
+        if v.__class__ is str and v:
             return v
-    v = deep_get(payload, ("data", "event"))
-    return v if isinstance(v, str) else ""
+    v = deep_get(payload, _EVENT_NESTED_PATH)
+    return v if v.__class__ is str else ""
+
+
+# ---------------- final lead message ----------------
+_SPAM_HINT = "Если письма нет — проверь «Спам»/«Промоакции» и попробуй зайти по ссылке ниже под этим email."
+
+_MSG_HEAD = "✅ Отлично, данные приняты.\n📩 Email для Skillspace: "
+_MSG_INVITE_OK = "\n🎟️ Я отправил приглашение на курс в Skillspace.\n" + _SPAM_HINT
+_MSG_INVITE_FAIL = "\n⚠️ Приглашение не отправилось автоматически (бывает).\n" + _SPAM_HINT
+_MSG_INVITE_DISABLED = "\nℹ️ Авто-инвайт выключен (нужны SKILLSPACE_COURSE_ID и SKILLSPACE_API_KEY).\n🔧 Причина: "
+
+_MSG_NEXT_STEPS = (
+    "\n\nЧто дальше:"
+    "\n1.Проходи обучение."
+    "\n2.Сделай домашнее задание."
+    "\n3.Как сделаешь напиши по указанному телеграмму ниже."
+)
+_MSG_FOOTER = (
+    "\n\nВажно, пиши только если просмотрел видео-уроки и выполнил домашнее задание."
+    '\n\nВопросы по поводу "условий" работы ты можешь посмотреть на сайте https://procto13llcwork.work/'
+    "\n\nА как будет выглядеть процесс работы ты сможешь узнать на курсе, не бойся , курс не длинный и достаточно интересный."
+)
+
+
+def build_message_tail(course_url: str, contact_line: str) -> str:
+    # env-dependent part of the final message (course link, contact)
+    tail = ""
+    if course_url:
+        tail += (
+            "\n\n🔗 Ссылка на курс:\n"
+            + course_url
+            + "\nГлавное заходить с того же браузерного профиля где установлена указанная почта."
+        )
+    tail += _MSG_NEXT_STEPS
+    if contact_line:
+        tail += "\n" + contact_line
+    return tail + _MSG_FOOTER
+
+
+# ---------------- config ----------------
+@dataclass(frozen=True, slots=True)
+class Config:
+    # built once in lifespan; handlers read it via request.app.state.cfg
+    webhook_secret_bytes: bytes
+    telegram_secret_bytes: bytes
+    bot: BotService
 
 
 # ---------------- app lifespan ----------------
@@ -92,12 +169,46 @@ async def lifespan(app: FastAPI):
     # Contact text (you set this)
     contact_line = os.getenv("CONTACT_LINE", "").strip()
 
+    # Telegram webhook mode (optional): public URL of /telegram-webhook; polling is skipped
+    tg_webhook_url = os.getenv("TELEGRAM_WEBHOOK_URL", "").strip()
+    # same value in every worker unless set explicitly
+    tg_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET", "").strip() or hashlib.sha256(bot_token.encode()).hexdigest()
+    # parallel deliveries Telegram may open to us (Bot API allows 1-100, default 40)
+    tg_max_connections = int(os.getenv("TELEGRAM_WEBHOOK_MAX_CONNECTIONS", "100"))
+
+    # FSM storage: Redis if set (shared between workers), otherwise in-memory
+    redis_url = os.getenv("REDIS_URL", "").strip()
+
     # Sheets
     sheets = SheetsClient(sheet_id=sheet_id, worksheet_name=ws_name, service_account_json=sa_json)
 
+    # Dedicated pool for blocking Sheets I/O (not shared with anyio's default limiter)
+    executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("THREAD_POOL_SIZE", "40")),
+        thread_name_prefix="sheets",
+    )
+
+    # One keep-alive client for Skillspace API calls (HTTP/2 if the server offers it via ALPN)
+    http = httpx.AsyncClient(
+        timeout=25,
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20),
+    )
+
+    # ---------- YOUR FINAL MESSAGE (NO TEST CHECKS) ----------
+    # Only the email and the invite error vary per lead; the env-dependent
+    # parts are assembled once here from the module-level fragments.
+    invite_enabled = bool(expected_course_id and skillspace_api_key)
+    if not expected_course_id:
+        msg_invite_disabled = _MSG_INVITE_DISABLED + "Не задан SKILLSPACE_COURSE_ID"
+    else:
+        msg_invite_disabled = _MSG_INVITE_DISABLED + "Не задан SKILLSPACE_API_KEY"
+    msg_tail = build_message_tail(course_url, contact_line)
+
     async def on_lead_completed(profile: LeadProfile) -> str:
         now = utc_iso()
 
+        # Invite first, then write the lead once with the resulting stage
         lead = LeadData(
             telegram_id=profile.telegram_id,
             email=profile.email,
@@ -109,17 +220,10 @@ async def lifespan(app: FastAPI):
             amazon_experience=profile.amazon_experience,
             stage="PROFILE_COLLECTED",
         )
-
-        def _sync_upsert():
-            return sheets.upsert_lead(lead, now)
-
-        await anyio.to_thread.run_sync(_sync_upsert)
+        invite_block = msg_invite_disabled
 
         # Auto-invite (only if both course_id and api_key set)
-        invite_ok = False
-        invite_reason = ""
-
-        if expected_course_id and skillspace_api_key:
+        if invite_enabled:
             try:
                 await invite_student(
                     api_key=skillspace_api_key,
@@ -128,87 +232,41 @@ async def lifespan(app: FastAPI):
                     course_id=expected_course_id,
                     group_id=group_id,
                     base_url=skillspace_base_url,
+                    client=http,
                 )
-                invite_ok = True
-
-                def _sync_stage_invited():
-                    sheets.upsert_lead(
-                        LeadData(
-                            telegram_id=profile.telegram_id,
-                            email=profile.email,
-                            age=profile.age,
-                            gender=profile.gender,
-                            country=profile.country,
-                            language=profile.language,
-                            english_level=profile.english_level,
-                            amazon_experience=profile.amazon_experience,
-                            stage="INVITED_TO_COURSE",
-                        ),
-                        now,
-                    )
-
-                await anyio.to_thread.run_sync(_sync_stage_invited)
-
+                lead.stage = "INVITED_TO_COURSE"
+                invite_block = _MSG_INVITE_OK
             except (SkillspaceError, Exception) as e:
-                invite_reason = str(e)
-        else:
-            if not expected_course_id:
-                invite_reason = "Не задан SKILLSPACE_COURSE_ID"
-            elif not skillspace_api_key:
-                invite_reason = "Не задан SKILLSPACE_API_KEY"
-
-        # ---------- YOUR FINAL MESSAGE (NO TEST CHECKS) ----------
-        lines = []
-        lines.append("✅ Отлично, данные приняты.")
-        lines.append(f"📩 Email для Skillspace: {profile.email}")
-
-        if expected_course_id and skillspace_api_key and invite_ok:
-            lines.append("🎟️ Я отправил приглашение на курс в Skillspace.")
-            lines.append("Если письма нет — проверь «Спам»/«Промоакции» и попробуй зайти по ссылке ниже под этим email.")
-        elif expected_course_id and skillspace_api_key and not invite_ok:
-            lines.append("⚠️ Приглашение не отправилось автоматически (бывает).")
-            lines.append("Если письма нет — проверь «Спам»/«Промоакции» и попробуй зайти по ссылке ниже под этим email.")
-            if invite_reason:
-                lines.append(f"🔧 Тех. причина: {invite_reason}")
-        else:
-            lines.append("ℹ️ Авто-инвайт выключен (нужны SKILLSPACE_COURSE_ID и SKILLSPACE_API_KEY).")
-            if invite_reason:
-                lines.append(f"🔧 Причина: {invite_reason}")
-
-        if course_url:
-            lines.append("")
-            lines.append("🔗 Ссылка на курс:")
-            lines.append(course_url)
-            lines.append("Главное заходить с того же браузерного профиля где установлена указанная почта.")
-
-        lines.append("")
-        lines.append("Что дальше:")
-        lines.append("1.Проходи обучение.")
-        lines.append("2.Сделай домашнее задание.")
-        lines.append("3.Как сделаешь напиши по указанному телеграмму ниже.")
-        if contact_line:
-            lines.append(contact_line)
-
-        lines.append("")
-        lines.append("Важно, пиши только если просмотрел видео-уроки и выполнил домашнее задание.")
-        lines.append("")
-        lines.append('Вопросы по поводу "условий" работы ты можешь посмотреть на сайте https://procto13llcwork.work/')
-        lines.append("")
-        lines.append("А как будет выглядеть процесс работы ты сможешь узнать на курсе, не бойся , курс не длинный и достаточно интересный.")
-
-        return "\n".join(lines)
-
-    bot_service = BotService(token=bot_token, on_lead_completed=on_lead_completed)
+                invite_block = _MSG_INVITE_FAIL
+                if str(e):
+                    invite_block += f"\n🔧 Тех. причина: {e}"
+
+        # a failed write must not cost the student the reply (the invite may already be sent)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(executor, sheets.upsert_lead, lead, now)
+        except Exception:
+            logger.exception("Sheets upsert failed for %s (tg:%s)", profile.email, profile.telegram_id)
+
+        return _MSG_HEAD + profile.email + invite_block + msg_tail
+
+    bot_service = BotService(token=bot_token, on_lead_completed=on_lead_completed, redis_url=redis_url)
 
     # Store shared state
-    app.state.sheets = sheets
-    app.state.bot = bot_service
-    app.state.webhook_secret = webhook_secret
+    app.state.cfg = Config(
+        webhook_secret_bytes=webhook_secret.encode(),
+        telegram_secret_bytes=tg_secret.encode() if tg_webhook_url else b"",
+        bot=bot_service,
+    )
 
-    # Start polling
+    # Start polling (or register the webhook)
     enable_polling = os.getenv("ENABLE_POLLING", "1").strip() == "1"
     polling_task = None
-    if enable_polling:
+    if tg_webhook_url:
+        if await bot_service.start_webhook(tg_webhook_url, tg_secret, tg_max_connections):
+            logger.info("Telegram webhook registered")
+        logger.info("Started. Bot webhook is set, polling is off. Skillspace webhook is ready (stub mode).")
+    elif enable_polling:
         polling_task = asyncio.create_task(bot_service.start_polling())
         logger.info("Started. Bot polling is running. Skillspace webhook is ready (stub mode).")
     else:
@@ -224,12 +282,51 @@ async def lifespan(app: FastAPI):
             await bot_service.stop()
         except Exception:
             pass
+        await http.aclose()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+# ---------------- dependencies ----------------
+def get_cfg(request: Request) -> Config:
+    return request.app.state.cfg
+
+
+async def verify_token(token: str, cfg: Config = Depends(get_cfg)) -> None:
+    # constant-time compare; runs before the handler touches the body
+    if not hmac.compare_digest(token.encode(), cfg.webhook_secret_bytes):
+        raise HTTPException(status_code=401, detail="Bad token")
+
+
+# Skillspace events are a few KB; anything far larger is not a real delivery
+WEBHOOK_MAX_BYTES = 64_000
+
+
+async def limited_body(request: Request) -> bytes:
+    cl = request.headers.get("content-length", "")
+    if cl.isdigit() and int(cl) > WEBHOOK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > WEBHOOK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
 
 
 # ---------------- routes ----------------
+# Constant bodies: built once, returned as-is (no serializer per request)
+_HEALTHZ = Response(content=b'{"ok":true}', media_type="application/json")
+_TELEGRAM_STUB = Response(content=b'{"ok":true,"mode":"polling"}', media_type="application/json")
+_TELEGRAM_OK = Response(content=b'{"ok":true}', media_type="application/json")
+_SKILLSPACE_IGNORED = Response(content=b'{"ok":true,"ignored":true}', media_type="application/json")
+
+
 # ✅ allow HEAD so free UptimeRobot checks don't get 405
 @app.api_route("/", methods=["GET", "HEAD"])
 async def root():
@@ -239,30 +336,57 @@ async def root():
 # ✅ allow HEAD so free UptimeRobot checks don't get 405
 @app.api_route("/healthz", methods=["GET", "HEAD"])
 async def healthz():
-    return {"ok": True}
+    return _HEALTHZ
 
 
 @app.post("/telegram-webhook")
-async def telegram_webhook_stub():
-    # Polling mode: webhook is not used; keep endpoint to avoid 404 if something hits it.
-    return JSONResponse({"ok": True, "mode": "polling"}, status_code=200)
+async def telegram_webhook(request: Request, cfg: Config = Depends(get_cfg)):
+    if not cfg.telegram_secret_bytes:
+        # Polling mode: webhook is not used; keep endpoint to avoid 404 if something hits it.
+        return _TELEGRAM_STUB
+
+    token = request.headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(token.encode(), cfg.telegram_secret_bytes):
+        raise HTTPException(status_code=401, detail="Bad token")
+
+    try:
+        # no size cap here: the secret is already checked, and a 413 would make
+        # Telegram redeliver a long (but genuine) update forever
+        cfg.bot.feed_webhook_body(await request.body())
+    except ValidationError:
+        # not an Update: ack anyway, otherwise Telegram keeps redelivering it
+        logger.warning("Telegram webhook: unparsable update ignored")
+    return _TELEGRAM_OK
 
 
-@app.post("/skillspace-webhook")
-async def skillspace_webhook(request: Request, token: str):
+@app.post("/skillspace-webhook", dependencies=[Depends(verify_token)])
+async def skillspace_webhook(body: bytes = Depends(limited_body)):
     """
     STUB endpoint:
     Skillspace can keep sending webhooks here, but we DO NOT evaluate tests and DO NOT message user.
     We just return 200 OK to acknowledge receipt.
     """
-    if token != app.state.webhook_secret:
-        raise HTTPException(status_code=401, detail="Bad token")
+    event_name = ""
+    if any(marker in body for marker in _EVENT_KEY_MARKERS):
+        try:
+            event_name = extract_skillspace_event(orjson.loads(body))
+        except Exception:
+            logger.info("Skillspace webhook received (ignored): non-json payload")
+            return _SKILLSPACE_IGNORED
 
-    try:
-        payload = await request.json()
-        event_name = extract_skillspace_event(payload)
-        logger.info(f"Skillspace webhook received (ignored): event={event_name}")
-    except Exception:
-        logger.info("Skillspace webhook received (ignored): non-json payload")
+    logger.info("Skillspace webhook received (ignored): event=%s", event_name)
+    return _SKILLSPACE_IGNORED
+
+
+if __name__ == "__main__":
+    import uvicorn
 
-    return {"ok": True, "ignored": True}
+    # uvloop + httptools ship with uvicorn[standard]. CLI equivalent:
+    #   uvicorn app:app --loop uvloop --http httptools
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+    )
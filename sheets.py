@@ -1,10 +1,17 @@
 import base64
+import functools
 import json
+import random
+import threading
+import time
 from dataclasses import dataclass
 from typing import Any, Dict, Optional, Tuple, List
 
 import gspread
+from gspread.utils import a1_to_rowcol
 from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 REQUIRED_HEADERS = [
@@ -26,7 +33,53 @@ REQUIRED_HEADERS = [
 ]
 
 
-@dataclass
+# column number -> letter for the single-letter range (index 0 unused)
+_COL_LETTERS = [""] + [chr(65 + i) for i in range(26)]
+
+
+# ---------------- auth ----------------
+def _decode_service_json(service_account_json: str) -> Dict[str, Any]:
+    raw = (service_account_json or "").strip()
+    if not raw:
+        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is empty")
+
+    if raw.startswith("{") and raw.endswith("}"):
+        return json.loads(raw)
+
+    try:
+        decoded = base64.b64decode(raw).decode("utf-8")
+        return json.loads(decoded)
+    except Exception as e:
+        raise RuntimeError(
+            "GOOGLE_SERVICE_ACCOUNT_JSON must be JSON string or base64-encoded JSON"
+        ) from e
+
+
+# One authorized client per process: the JSON/RSA key is parsed once and
+# every SheetsClient built from the same credentials shares its session.
+@functools.lru_cache(maxsize=1)
+def _make_client(service_account_json: str) -> gspread.Client:
+    info = _decode_service_json(service_account_json)
+    # open_by_key + values.* only need the Sheets scope
+    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+    creds = Credentials.from_service_account_info(info, scopes=scopes)
+    gc = gspread.authorize(creds)
+
+    # Keep-alive pool + backoff on quota (429) / transient 5xx for idempotent calls.
+    # POSTs (append, batchUpdate) are not retried by urllib3's default method list.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    gc.http_client.session.mount(
+        "https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+    )
+    return gc
+
+
+@dataclass(slots=True)
 class LeadData:
     telegram_id: int
     email: str
@@ -44,51 +97,53 @@ class SheetsClient:
         self.sheet_id = sheet_id
         self.worksheet_name = worksheet_name
         self.service_account_json = service_account_json
-        self._gc = self._make_client()
-
-    # ---------------- auth ----------------
-    def _decode_service_json(self) -> Dict[str, Any]:
-        raw = (self.service_account_json or "").strip()
-        if not raw:
-            raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON is empty")
-
-        if raw.startswith("{") and raw.endswith("}"):
-            return json.loads(raw)
-
-        try:
-            decoded = base64.b64decode(raw).decode("utf-8")
-            return json.loads(decoded)
-        except Exception as e:
-            raise RuntimeError(
-                "GOOGLE_SERVICE_ACCOUNT_JSON must be JSON string or base64-encoded JSON"
-            ) from e
-
-    def _make_client(self) -> gspread.Client:
-        info = self._decode_service_json()
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-        ]
-        creds = Credentials.from_service_account_info(info, scopes=scopes)
-        return gspread.authorize(creds)
+        self._gc = _make_client(service_account_json)
+        # opened lazily on first use (from a worker thread, not the event loop)
+        self._ws = None
+        # email / telegram_id -> row; None until the first full read
+        self._email_idx: Optional[Dict[str, int]] = None
+        self._tg_idx: Dict[str, int] = {}
+        # full read made by _get_ws in the current op, consumed by _find_row
+        self._fresh_values: Optional[List[List[str]]] = None
+        # ops run on executor threads; serialize them around the shared caches
+        self._lock = threading.Lock()
+        # header row + name->column map as of the last schema check
+        self._headers_cache: Optional[List[str]] = None
+        self._header_idx_cache: Optional[Dict[str, int]] = None
 
     # ---------------- worksheet + schema ----------------
     def _get_ws(self):
-        sh = self._gc.open_by_key(self.sheet_id)
-        ws = sh.worksheet(self.worksheet_name) if self.worksheet_name else sh.get_worksheet(0)
-        self._ensure_schema(ws)
-        return ws
-
-    def _ensure_schema(self, ws) -> None:
+        if self._ws is None:
+            sh = self._gc.open_by_key(self.sheet_id)
+            ws = sh.worksheet(self.worksheet_name) if self.worksheet_name else sh.get_worksheet(0)
+            # one read serves both the schema check and the lead index;
+            # the caller's lookup reuses it instead of reading again
+            self._fresh_values = self._load_index(ws)
+            self._ws = ws
+        return self._ws
+
+    def _drop_ws(self) -> None:
+        # caller holds the lock
+        self._ws = None
+        self._email_idx = None
+        self._tg_idx = {}
+        self._fresh_values = None
+
+    def refresh_ws(self) -> None:
+        """Reopen the worksheet (schema check + index) on next use, e.g. after the tab was renamed."""
+        with self._lock:
+            self._drop_ws()
+
+    def _ensure_schema(self, ws, headers: List[str]) -> None:
         """
         1) If header row missing => write REQUIRED_HEADERS
         2) If header row exists but missing some required columns => append missing columns to the right
         """
-        headers = ws.row_values(1)
 
         # Empty sheet => create headers
         if not headers:
             ws.append_row(REQUIRED_HEADERS, value_input_option="RAW")
+            self._set_headers(list(REQUIRED_HEADERS))
             return
 
         existing = [h.strip() for h in headers if h and h.strip()]
@@ -96,18 +151,42 @@ class SheetsClient:
 
         missing = [h for h in REQUIRED_HEADERS if h not in existing_set]
         if not missing:
+            self._set_headers([h.strip() for h in headers])
             return
 
         # Append missing columns to the end of header row without breaking existing column alignment
         new_headers = existing + missing
 
         # Ensure row 1 has enough columns; update range A1:...
-        ws.update(f"A1:{self._col_letter(len(new_headers))}1", [new_headers])
+        ws.update(
+            values=[new_headers],
+            range_name=f"A1:{self._col_letter(len(new_headers))}1",
+            value_input_option="RAW",
+        )
+        self._set_headers(new_headers)
+
+    def _set_headers(self, headers: List[str]) -> None:
+        self._headers_cache = headers
+        self._header_idx_cache = self._header_index(headers)
 
     def _headers(self, ws) -> List[str]:
-        headers = ws.row_values(1)
-        # Normalize (strip)
-        return [h.strip() for h in headers]
+        if self._headers_cache is None:
+            headers = ws.row_values(1)
+            # Normalize (strip)
+            self._set_headers([h.strip() for h in headers])
+        return self._headers_cache
+
+    def _header_map(self, ws) -> Dict[str, int]:
+        self._headers(ws)
+        return self._header_idx_cache
+
+    @staticmethod
+    def _header_row(values: List[List[str]]) -> List[str]:
+        # row 1 as read, stripped, without trailing blank cells
+        headers = [h.strip() for h in values[0]] if values else []
+        while headers and not headers[-1]:
+            headers.pop()
+        return headers
 
     def _header_index(self, headers: List[str]) -> Dict[str, int]:
         # 1-based for gspread
@@ -116,6 +195,8 @@ class SheetsClient:
     @staticmethod
     def _col_letter(n: int) -> str:
         # 1 -> A, 26 -> Z, 27 -> AA ...
+        if 0 < n < len(_COL_LETTERS):
+            return _COL_LETTERS[n]
         s = ""
         while n > 0:
             n, r = divmod(n - 1, 26)
@@ -123,29 +204,214 @@ class SheetsClient:
         return s
 
     # ---------------- find helpers ----------------
-    def _find_row_by_email(self, ws, email: str) -> Optional[int]:
-        if not email:
-            return None
-        try:
-            cell = ws.find(email)
-            return cell.row if cell else None
-        except Exception:
-            return None
+    def _load_index(self, ws) -> List[List[str]]:
+        """
+        One full read -> {email: row} and {telegram_id: row}.
+        First match wins (same as ws.find). Returns the values that were read.
+        Row 1 comes with it, so the schema check and header map are redone too:
+        columns may have been moved by hand since the last read.
+        """
+        values = ws.get_all_values()
+        self._ensure_schema(ws, self._header_row(values))
+        self._build_index(values)
+        return values
+
+    def _build_index(self, values: List[List[str]]) -> None:
+        idx = self._header_idx_cache or {}
+        email_i = idx.get("email", 0) - 1
+        tg_i = idx.get("telegram_id", 0) - 1
+
+        email_idx: Dict[str, int] = {}
+        tg_idx: Dict[str, int] = {}
+        for row, vals in enumerate(values[1:], start=2):
+            if 0 <= email_i < len(vals) and vals[email_i]:
+                email_idx.setdefault(vals[email_i], row)
+            if 0 <= tg_i < len(vals) and vals[tg_i]:
+                tg_idx.setdefault(vals[tg_i], row)
+
+        self._email_idx = email_idx
+        self._tg_idx = tg_idx
+
+    def _reload_index(self, ws) -> Optional[List[List[str]]]:
+        """
+        Rebuild the index from row 1 + the email/telegram_id columns (one batchGet).
+        If those columns moved since the header map was built, fall back to a
+        full read and return its values; otherwise return None.
+        """
+        idx = self._header_idx_cache or {}
+        email_col = idx.get("email")
+        tg_col = idx.get("telegram_id")
+        if not email_col or not tg_col:
+            return self._load_index(ws)
+
+        e = self._col_letter(email_col)
+        t = self._col_letter(tg_col)
+        head_vr, email_vr, tg_vr = ws.batch_get(["1:1", f"{e}:{e}", f"{t}:{t}"])
+        headers = self._header_row(head_vr)
+        fresh = self._header_index(headers)
+        if fresh.get("email") != email_col or fresh.get("telegram_id") != tg_col:
+            return self._load_index(ws)
+        self._set_headers(headers)
+
+        # single-column ranges come back as one-cell rows ([] for a blank cell)
+        email_idx: Dict[str, int] = {}
+        tg_idx: Dict[str, int] = {}
+        for row, cells in enumerate(email_vr[1:], start=2):
+            if cells and cells[0]:
+                email_idx.setdefault(cells[0], row)
+        for row, cells in enumerate(tg_vr[1:], start=2):
+            if cells and cells[0]:
+                tg_idx.setdefault(cells[0], row)
+
+        self._email_idx = email_idx
+        self._tg_idx = tg_idx
+        return None
+
+    def _index_get(self, email: str, tg: str) -> Optional[int]:
+        row = self._email_idx.get(email) if email else None
+        if row is None and tg:
+            row = self._tg_idx.get(tg)
+        return row
+
+    def _row_is_lead(self, ws, current: List[str], email: str, tg: str) -> bool:
+        idx = self._header_map(ws)
+        for key, want in (("email", email), ("telegram_id", tg)):
+            col = idx.get(key)
+            if want and col and col <= len(current) and current[col - 1] == want:
+                return True
+        return False
 
-    def _find_row_by_telegram(self, ws, telegram_id: int) -> Optional[int]:
+    def _find_row(self, ws, email: str, telegram_id: Optional[int] = None) -> Tuple[Optional[int], List[str]]:
+        """
+        Row of the lead (by email, then telegram_id) and its current values.
+        The sheet is edited by hand too, so a cached hit is checked against the
+        row it points to; a miss or a stale hit rebuilds the index once from the
+        key columns.
+        """
+        tg = "" if telegram_id is None else str(telegram_id)
+
+        fresh, self._fresh_values = self._fresh_values, None
+        if fresh is not None:
+            # the sheet was read in full a moment ago: index and values are current
+            row = self._index_get(email, tg)
+            if row is None:
+                return None, []
+            return row, fresh[row - 1]
+
+        if self._email_idx is not None:
+            row = self._index_get(email, tg)
+            if row is not None:
+                # header row + lead row in one request; writes use this fresh map
+                head_vr, row_vr = ws.batch_get(["1:1", f"{row}:{row}"])
+                self._set_headers(self._header_row(head_vr))
+                current = row_vr[0] if row_vr else []
+                if self._row_is_lead(ws, current, email, tg):
+                    return row, current
+
+        # miss or stale hit: re-read only the key columns (new leads land here)
+        values = self._reload_index(ws)
+        row = self._index_get(email, tg)
+        if row is None:
+            return None, []
+        if values is not None:
+            return row, values[row - 1]
+        return row, ws.row_values(row)
+
+    @staticmethod
+    def _appended_row(resp: Any) -> Optional[int]:
+        # values.append response: {"updates": {"updatedRange": "Sheet1!A42:O42"}} -> 42
         try:
-            cell = ws.find(str(telegram_id))
-            return cell.row if cell else None
+            rng = resp["updates"]["updatedRange"]
+            return a1_to_rowcol(rng.rpartition("!")[2].partition(":")[0])[0]
         except Exception:
             return None
 
+    # ---------------- write helpers ----------------
+    def _locked(self, fn, *args, **kwargs):
+        """
+        Run one op under the lock; retry it when Sheets answers 429 (quota).
+        Needed for POSTs (append, batchUpdate), which the HTTP adapter does not retry;
+        a 429 means nothing was written, so resending is safe. The backoff sleep
+        happens with the lock released so other leads are not held up, and the
+        whole op reruns, so the row is looked up again afterwards.
+
+        Any other APIError reopens the worksheet and reruns the op once: gspread
+        builds every range from the cached tab title, so a tab renamed or
+        recreated by hand would otherwise fail every op until restart.
+        """
+        attempt = 0
+        reopened = False
+        while True:
+            with self._lock:
+                try:
+                    return fn(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    if e.response.status_code != 429:
+                        if reopened:
+                            raise
+                        self._drop_ws()
+                        reopened = True
+                        continue
+                    if attempt == 3:
+                        raise
+            time.sleep(2**attempt + random.random())
+            attempt += 1
+
+    def _row_matches(self, current: List[str], idx: Dict[str, int], values: Dict[str, str]) -> bool:
+        """True if the row already holds these values (timestamps are not compared)."""
+        for key, val in values.items():
+            if key in ("created_at", "updated_at"):
+                continue
+            col = idx.get(key)
+            if not col:
+                continue
+            cur = current[col - 1] if col <= len(current) else ""
+            if cur != val:
+                return False
+        return True
+
+    def _span_range(self, row: int, start: int, end: int, vals: List[str]) -> Dict[str, Any]:
+        a1 = f"{self._col_letter(start)}{row}"
+        if end != start:
+            a1 += f":{self._col_letter(end)}{row}"
+        return {"range": a1, "values": [vals]}
+
+    def _write_cells(self, ws, row: int, idx: Dict[str, int], values: Dict[str, str]) -> None:
+        """
+        Write the given {header: value} cells of one row in a single batchUpdate.
+        Adjacent columns are merged into one range each.
+        Columns missing from the sheet are skipped; other columns are left untouched.
+        """
+        cells = sorted((idx[key], val) for key, val in values.items() if idx.get(key))
+
+        data = []
+        start = prev = 0
+        span: List[str] = []
+        for col, val in cells:
+            if span and col != prev + 1:
+                data.append(self._span_range(row, start, prev, span))
+                span = []
+            if not span:
+                start = col
+            span.append(val)
+            prev = col
+        if span:
+            data.append(self._span_range(row, start, prev, span))
+
+        if data:
+            ws.batch_update(data, value_input_option="RAW")
+
     # ---------------- public ops ----------------
     def upsert_lead(self, lead: LeadData, now_iso: str) -> Tuple[int, str]:
+        return self._locked(self._upsert_lead, lead, now_iso)
+
+    def _upsert_lead(self, lead: LeadData, now_iso: str) -> Tuple[int, str]:
         ws = self._get_ws()
-        headers = self._headers(ws)
-        idx = self._header_index(headers)
 
-        row = self._find_row_by_email(ws, lead.email) or self._find_row_by_telegram(ws, lead.telegram_id)
+        # finding the row also refreshes the header map
+        row, current = self._find_row(ws, lead.email, lead.telegram_id)
+        headers = self._headers(ws)
+        idx = self._header_map(ws)
 
         values_map = {
             "created_at": now_iso,
@@ -168,22 +434,27 @@ class SheetsClient:
         # INSERT
         if row is None:
             row_values = [values_map.get(h, "") for h in headers]
-            ws.append_row(row_values, value_input_option="RAW")
-            new_row = len(ws.get_all_values())
+            resp = ws.append_row(row_values, value_input_option="RAW")
+            new_row = self._appended_row(resp)
+            if new_row is None:
+                new_row = len(self._load_index(ws))
+            else:
+                if lead.email:
+                    self._email_idx.setdefault(lead.email, new_row)
+                self._tg_idx.setdefault(str(lead.telegram_id), new_row)
             return new_row, "insert"
 
         # UPDATE (не трогаем created_at если колонка есть)
         created_col = idx.get("created_at")
-        if created_col:
-            existing_created = (ws.cell(row, created_col).value or "").strip()
+        if created_col and created_col <= len(current):
+            existing_created = current[created_col - 1].strip()
             if existing_created:
                 values_map["created_at"] = existing_created
 
-        for key, val in values_map.items():
-            col = idx.get(key)
-            if col:
-                ws.update_cell(row, col, val)
+        if self._row_matches(current, idx, values_map):
+            return row, "unchanged"
 
+        self._write_cells(ws, row, idx, values_map)
         return row, "update"
 
     def update_from_skillspace(
@@ -197,12 +468,7 @@ class SheetsClient:
         lesson_id: Optional[str],
         course_id: Optional[str],
     ) -> Optional[int]:
-        ws = self._get_ws()
-        headers = self._headers(ws)
-        idx = self._header_index(headers)
-
-        row = self._find_row_by_email(ws, email)
-        if row is None:
+        if not email:
             return None
 
         updates = {
@@ -213,26 +479,39 @@ class SheetsClient:
             "lesson_id": lesson_id or "",
             "course_id": course_id or "",
         }
+        return self._locked(self._update_from_skillspace, email, updates)
 
-        for key, val in updates.items():
-            col = idx.get(key)
-            if col:
-                ws.update_cell(row, col, val)
+    def _update_from_skillspace(self, email: str, updates: Dict[str, str]) -> Optional[int]:
+        ws = self._get_ws()
+
+        row, current = self._find_row(ws, email)
+        if row is None:
+            return None
+        idx = self._header_map(ws)
+
+        # replayed event: nothing but the timestamp would change
+        if self._row_matches(current, idx, updates):
+            return row
 
+        self._write_cells(ws, row, idx, updates)
         return row
 
     def get_telegram_id_by_email(self, email: str) -> Optional[int]:
+        if not email:
+            return None
+        return self._locked(self._get_telegram_id_by_email, email)
+
+    def _get_telegram_id_by_email(self, email: str) -> Optional[int]:
         ws = self._get_ws()
-        headers = self._headers(ws)
-        idx = self._header_index(headers)
 
-        row = self._find_row_by_email(ws, email)
+        # same index + verified row read as the write paths
+        row, current = self._find_row(ws, email)
         if row is None:
             return None
 
-        col = idx.get("telegram_id")
-        if not col:
+        tg_col = self._header_map(ws).get("telegram_id")
+        val = current[tg_col - 1].strip() if tg_col and tg_col <= len(current) else ""
+        try:
+            return int(val)
+        except ValueError:
             return None
-
-        val = (ws.cell(row, col).value or "").strip()
-        return int(val) if val.isdigit() else None
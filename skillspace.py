@@ -1,3 +1,5 @@
+from typing import Optional
+
 import httpx
 
 
@@ -13,6 +15,7 @@ async def invite_student(
     course_id: str,
     group_id: str = "",
     base_url: str = "https://skillspace.ru",
+    client: Optional[httpx.AsyncClient] = None,
 ) -> None:
     """
     Skillspace API:
@@ -21,6 +24,7 @@ async def invite_student(
     courses передаётся как php-array:
       courses[COURSE_ID]=GROUP_ID
     group_id может быть пустым — Skillspace выберет автоматически.
+    client — общий httpx.AsyncClient (keep-alive); без него создаётся разовый.
     """
     url = f"{base_url.rstrip('/')}/api/open/v1/course/student-invite"
 
@@ -31,8 +35,11 @@ async def invite_student(
         f"courses[{course_id}]": group_id or "",
     }
 
-    async with httpx.AsyncClient(timeout=25) as client:
+    if client is not None:
         r = await client.post(url, params=params)
+    else:
+        async with httpx.AsyncClient(timeout=25) as c:
+            r = await c.post(url, params=params)
 
     if r.status_code == 200:
         return
@@ -0,0 +1,405 @@
+import re
+
+import gspread
+import pytest
+from gspread.utils import a1_to_rowcol
+
+import sheets
+from sheets import REQUIRED_HEADERS, LeadData, SheetsClient
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": "quota", "status": "RESOURCE_EXHAUSTED"}}
+
+
+class FakeWorksheet:
+    """In-memory worksheet with the subset of gspread's API SheetsClient uses."""
+
+    def __init__(self, rows):
+        self.rows = [list(r) for r in rows]
+        self.calls = []
+        self.fail_writes = 0  # next N writes answer 429
+        self.stale = False  # tab renamed since this handle was opened
+        self.opened = 0
+
+    def rename(self):
+        # gspread keeps the old title in the handle; every range built from it is rejected
+        self.stale = True
+
+    def _check_title(self):
+        if self.stale:
+            raise gspread.exceptions.APIError(FakeResponse(400))
+
+    def _maybe_throttle(self):
+        if self.fail_writes:
+            self.fail_writes -= 1
+            raise gspread.exceptions.APIError(FakeResponse(429))
+
+    def _set(self, row, col, val):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = val
+
+    def _write(self, a1, values):
+        start = a1.rpartition("!")[2].partition(":")[0]
+        r0, c0 = a1_to_rowcol(start)
+        for i, cells in enumerate(values):
+            for j, val in enumerate(cells):
+                self._set(r0 + i, c0 + j, val)
+
+    def _last_row(self):
+        n = len(self.rows)
+        while n and not any(self.rows[n - 1]):
+            n -= 1
+        return n
+
+    def get_all_values(self):
+        self.calls.append("get_all_values")
+        self._check_title()
+        rows = self.rows[: self._last_row()]
+        width = max((len(r) for r in rows), default=0)
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def row_values(self, row):
+        self.calls.append("row_values")
+        self._check_title()
+        cells = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while cells and not cells[-1]:
+            cells.pop()
+        return cells
+
+    def batch_get(self, ranges, major_dimension=None):
+        self.calls.append("batch_get")
+        self._check_title()
+        assert major_dimension in (None, "ROWS")
+        out = []
+        for rng in ranges:
+            m = re.fullmatch(r"(\d+):(\d+)", rng)
+            if m:
+                row = int(m.group(1))
+                cells = list(self.rows[row - 1]) if row <= len(self.rows) else []
+                while cells and not cells[-1]:
+                    cells.pop()
+                out.append([cells] if cells else [])
+                continue
+            col = a1_to_rowcol(rng.partition(":")[0] + "1")[1]
+            column = [[r[col - 1]] if col <= len(r) and r[col - 1] else [] for r in self.rows]
+            while column and not column[-1]:
+                column.pop()
+            out.append(column)
+        return out
+
+    def append_row(self, values, value_input_option=None):
+        self.calls.append("append_row")
+        self._check_title()
+        self._maybe_throttle()
+        row = self._last_row() + 1
+        self._write(f"A{row}", [values])
+        end = SheetsClient._col_letter(max(len(values), 1))
+        return {"updates": {"updatedRange": f"Sheet1!A{row}:{end}{row}"}}
+
+    def update(self, values=None, range_name=None, value_input_option=None):
+        self.calls.append("update")
+        self._check_title()
+        self._write(range_name, values)
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls.append("batch_update")
+        self._check_title()
+        self._maybe_throttle()
+        for item in data:
+            self._write(item["range"], item["values"])
+
+    def record(self, row):
+        return dict(zip(self.rows[0], self.rows[row - 1]))
+
+
+class FakeSpreadsheet:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def worksheet(self, name):
+        return self.get_worksheet(0)
+
+    def get_worksheet(self, index):
+        self.ws.stale = False
+        self.ws.opened += 1
+        return self.ws
+
+
+class FakeClient:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def open_by_key(self, key):
+        return FakeSpreadsheet(self.ws)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(sheets.time, "sleep", calls.append)
+    return calls
+
+
+def make_client(monkeypatch, rows):
+    ws = FakeWorksheet(rows)
+    monkeypatch.setattr(sheets, "_make_client", lambda _json: FakeClient(ws))
+    return SheetsClient(sheet_id="id", worksheet_name=None, service_account_json="{}"), ws
+
+
+def lead(telegram_id=111, email="a@b.c", **kw):
+    kw.setdefault("stage", "PROFILE_COLLECTED")
+    return LeadData(telegram_id=telegram_id, email=email, **kw)
+
+
+def test_insert_into_empty_sheet_writes_headers_and_row(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+
+    assert client.upsert_lead(lead(age="30"), "T1") == (2, "insert")
+
+    assert ws.rows[0] == REQUIRED_HEADERS
+    rec = ws.record(2)
+    assert rec["email"] == "a@b.c"
+    assert rec["telegram_id"] == "111"
+    assert rec["age"] == "30"
+    assert rec["created_at"] == rec["updated_at"] == "T1"
+    # the opening read is reused for the first lookup
+    assert ws.calls.count("get_all_values") == 1
+
+
+def test_new_lead_reads_only_key_columns(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    ws.calls.clear()
+
+    assert client.upsert_lead(lead(222, "x@y.z"), "T2") == (3, "insert")
+    assert ws.calls == ["batch_get", "append_row"]
+
+
+def test_update_keeps_created_at_and_writes_one_batch(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(age="30"), "T1")
+    ws.calls.clear()
+
+    assert client.upsert_lead(lead(age="31", stage="INVITED_TO_COURSE"), "T2") == (2, "update")
+
+    rec = ws.record(2)
+    assert rec["created_at"] == "T1"
+    assert rec["updated_at"] == "T2"
+    assert rec["age"] == "31"
+    assert rec["stage"] == "INVITED_TO_COURSE"
+    assert ws.calls == ["batch_get", "batch_update"]
+    assert len(ws.rows) == 2
+
+
+def test_unchanged_lead_is_not_written(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(age="30"), "T1")
+    ws.calls.clear()
+
+    assert client.upsert_lead(lead(age="30"), "T2") == (2, "unchanged")
+    assert "batch_update" not in ws.calls
+    assert ws.record(2)["updated_at"] == "T1"
+
+
+def test_rows_sorted_by_hand_are_found_again(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(111, "a@b.c"), "T1")
+    client.upsert_lead(lead(222, "x@y.z"), "T1")
+    ws.rows[1], ws.rows[2] = ws.rows[2], ws.rows[1]
+
+    assert client.upsert_lead(lead(111, "a@b.c", age="40"), "T2") == (3, "update")
+    assert ws.record(3)["age"] == "40"
+    assert ws.record(2)["email"] == "x@y.z"
+    assert ws.record(2)["age"] == ""
+
+
+def test_row_added_by_hand_is_updated_not_duplicated(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    manual = [""] * len(REQUIRED_HEADERS)
+    manual[REQUIRED_HEADERS.index("email")] = "m@n.o"
+    ws.rows.append(manual)
+
+    assert client.upsert_lead(lead(333, "m@n.o"), "T2") == (3, "update")
+    assert ws.record(3)["telegram_id"] == "333"
+    assert len(ws.rows) == 3
+
+
+def test_reordered_columns_are_picked_up(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(111, "a@b.c", age="30"), "T1")
+
+    # swap the email and telegram_id columns by hand
+    e = REQUIRED_HEADERS.index("email")
+    t = REQUIRED_HEADERS.index("telegram_id")
+    for r in ws.rows:
+        r[e], r[t] = r[t], r[e]
+
+    assert client.upsert_lead(lead(111, "a@b.c", age="31"), "T2") == (2, "update")
+    assert len(ws.rows) == 2
+    rec = ws.record(2)
+    assert rec["email"] == "a@b.c"
+    assert rec["telegram_id"] == "111"
+    assert rec["age"] == "31"
+
+    assert client.upsert_lead(lead(222, "x@y.z"), "T3") == (3, "insert")
+    rec = ws.record(3)
+    assert rec["email"] == "x@y.z"
+    assert rec["telegram_id"] == "222"
+
+
+def test_extra_columns_added_by_hand_are_kept(monkeypatch):
+    client, ws = make_client(monkeypatch, [REQUIRED_HEADERS + ["note"]])
+    client.upsert_lead(lead(), "T1")
+    ws.rows[1][len(REQUIRED_HEADERS)] = "call back"
+
+    client.upsert_lead(lead(stage="INVITED_TO_COURSE"), "T2")
+    assert ws.record(2)["note"] == "call back"
+
+
+def test_update_from_skillspace_merges_adjacent_columns(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    sent = []
+    real = ws.batch_update
+    monkeypatch.setattr(ws, "batch_update", lambda data, **kw: (sent.append(data), real(data, **kw)))
+
+    row = client.update_from_skillspace(
+        email="a@b.c",
+        stage="LESSON_DONE",
+        now_iso="T2",
+        event_name="test-end",
+        lesson_score=0.5,
+        lesson_id=None,
+        course_id="c1",
+    )
+
+    assert row == 2
+    assert [d["range"] for d in sent[0]] == ["B2", "K2:O2"]
+    rec = ws.record(2)
+    assert rec["stage"] == "LESSON_DONE"
+    assert rec["lesson_score"] == "0.5"
+    assert rec["course_id"] == "c1"
+
+
+def test_update_from_skillspace_unknown_email(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    assert client.update_from_skillspace(
+        email="nobody@b.c",
+        stage="X",
+        now_iso="T2",
+        event_name="e",
+        lesson_score=None,
+        lesson_id=None,
+        course_id=None,
+    ) is None
+
+
+def test_write_is_retried_after_429(monkeypatch, sleeps):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    ws.fail_writes = 2
+
+    assert client.upsert_lead(lead(stage="INVITED_TO_COURSE"), "T2") == (2, "update")
+    assert ws.record(2)["stage"] == "INVITED_TO_COURSE"
+    assert len(sleeps) == 2
+
+
+def test_insert_is_retried_after_429_without_duplicates(monkeypatch, sleeps):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    ws.fail_writes = 1
+
+    assert client.upsert_lead(lead(222, "x@y.z"), "T2") == (3, "insert")
+    assert len(ws.rows) == 3
+    assert len(sleeps) == 1
+
+
+def test_backoff_sleeps_with_the_lock_released(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    held = []
+    monkeypatch.setattr(sheets.time, "sleep", lambda _s: held.append(client._lock.locked()))
+    ws.fail_writes = 1
+
+    client.upsert_lead(lead(stage="X"), "T2")
+    assert held == [False]
+
+
+def test_429_gives_up_after_last_attempt(monkeypatch, sleeps):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    ws.fail_writes = 10
+
+    with pytest.raises(gspread.exceptions.APIError):
+        client.upsert_lead(lead(stage="X"), "T2")
+    assert len(sleeps) == 3
+
+
+def test_renamed_tab_is_reopened(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    ws.rename()
+
+    assert client.upsert_lead(lead(stage="INVITED_TO_COURSE"), "T2") == (2, "update")
+    assert ws.record(2)["stage"] == "INVITED_TO_COURSE"
+    assert ws.opened == 2
+    assert len(ws.rows) == 2
+
+
+def test_refresh_ws_reopens_on_next_use(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    client.refresh_ws()
+    ws.calls.clear()
+
+    assert client.upsert_lead(lead(stage="X"), "T2") == (2, "update")
+    assert ws.opened == 2
+    assert ws.calls == ["get_all_values", "batch_update"]
+
+
+def test_persistent_api_error_is_raised_after_one_reopen(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(), "T1")
+    monkeypatch.setattr(FakeSpreadsheet, "get_worksheet", lambda self, index: self.ws)
+    ws.rename()
+
+    with pytest.raises(gspread.exceptions.APIError):
+        client.upsert_lead(lead(stage="X"), "T2")
+
+
+def test_appended_row_parses_updated_range():
+    assert SheetsClient._appended_row({"updates": {"updatedRange": "Leads!A42:O42"}}) == 42
+    assert SheetsClient._appended_row({}) is None
+    assert SheetsClient._appended_row(None) is None
+
+
+def test_col_letter():
+    assert SheetsClient._col_letter(1) == "A"
+    assert SheetsClient._col_letter(26) == "Z"
+    assert SheetsClient._col_letter(27) == "AA"
+    assert SheetsClient._col_letter(703) == "AAA"
+
+
+def test_get_telegram_id_by_email(monkeypatch):
+    client, ws = make_client(monkeypatch, [])
+    client.upsert_lead(lead(111, "a@b.c"), "T1")
+    manual = [""] * len(REQUIRED_HEADERS)
+    manual[REQUIRED_HEADERS.index("email")] = "m@n.o"
+    manual[REQUIRED_HEADERS.index("telegram_id")] = "n/a"
+    ws.rows.append(manual)
+
+    assert client.get_telegram_id_by_email("a@b.c") == 111
+    assert client.get_telegram_id_by_email("m@n.o") is None
+    assert client.get_telegram_id_by_email("nobody@b.c") is None
+    assert client.get_telegram_id_by_email("") is None
@@ -1,6 +1,10 @@
+import asyncio
+import hashlib
+import logging
 import os
+import re
 from dataclasses import dataclass
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, Set
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.enums import ChatAction
@@ -13,8 +17,11 @@ from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Message,
+    Update,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class LeadForm(StatesGroup):
     email = State()
@@ -43,6 +50,16 @@ OnLeadCompleted = Callable[[LeadProfile], Awaitable[str]]
 
 HELP_LOGIN_CB = "help_login"
 
+# one "@", no spaces, a dot in the domain part
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+
+def _sanitize(m: Message, maxlen: int = 128) -> str:
+    # свободные ответы обрезаем, чтобы в state/таблицу не уходили простыни текста
+    t = m.text
+    return t.strip()[:maxlen] if t else ""
+
+
 def help_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -56,30 +73,53 @@ def help_keyboard() -> InlineKeyboardMarkup:
     )
 
 
+# можно легко менять ссылку через env, без правки кода (читается один раз при импорте)
+_COURSE_LINK = os.getenv("SKILLSPACE_PUBLIC_COURSE_URL", "https://855f92.skillspace.ru/course/102877").strip()
+
+# тексты собираются один раз; в обработчике подставляется только email
+_HELP_LOGIN_HEAD = (
+    "🆘 Инструкция, если не пришло письмо или не получается зайти\n\n"
+    "1) Переходим на skillspace.ru\n"
+    "   🇺🇦 Если вы проживаете в Украине — вам может понадобиться браузер Brave "
+    "или любой VPN, который скрывает IP. Не важно какой именно VPN. "
+    "Я рекомендую Brave либо любой бесплатный аналог.\n"
+    "   🌍 Если вы не проживаете в Украине — VPN не нужен.\n\n"
+    "2) Заходим по ссылке: " + _COURSE_LINK + "\n"
+    "   Сайт попросит логин и пароль.\n"
+    "   Нажимаем «Забыли пароль» / «Проблемы со входом».\n"
+    "   Указываем ту же почту, что вводили в боте: "
+)
+_HELP_LOGIN_TAIL = "\n   Дальше устанавливаем новый пароль — и всё готово ✅"
+
+_HELP_LOGIN_GENERIC = (
+    "🆘 Инструкция, если не пришло письмо или не получается зайти\n\n"
+    "1) Переходим на skillspace.ru\n"
+    "   🇺🇦 Если вы проживаете в Украине — вам может понадобиться Brave или VPN.\n"
+    "   🌍 Если вы не проживаете в Украине — VPN не нужен.\n\n"
+    "2) Заходим по ссылке: " + _COURSE_LINK + "\n"
+    "   Нажимаем «Забыли пароль» / «Проблемы со входом».\n"
+    "   Указываем ту же почту, что вводили в боте.\n"
+    "   Устанавливаем новый пароль — и всё готово ✅"
+)
+
+
 def build_help_login_text(email: str) -> str:
-    # можно легко менять ссылку через env, без правки кода
-    course_link = os.getenv("SKILLSPACE_PUBLIC_COURSE_URL", "https://855f92.skillspace.ru/course/102877").strip()
-
-    return (
-        "🆘 Инструкция, если не пришло письмо или не получается зайти\n\n"
-        "1) Переходим на skillspace.ru\n"
-        "   🇺🇦 Если вы проживаете в Украине — вам может понадобиться браузер Brave "
-        "или любой VPN, который скрывает IP. Не важно какой именно VPN. "
-        "Я рекомендую Brave либо любой бесплатный аналог.\n"
-        "   🌍 Если вы не проживаете в Украине — VPN не нужен.\n\n"
-        f"2) Заходим по ссылке: {course_link}\n"
-        "   Сайт попросит логин и пароль.\n"
-        "   Нажимаем «Забыли пароль» / «Проблемы со входом».\n"
-        f"   Указываем ту же почту, что вводили в боте: {email}\n"
-        "   Дальше устанавливаем новый пароль — и всё готово ✅"
-    )
+    return _HELP_LOGIN_HEAD + email + _HELP_LOGIN_TAIL
 
 
 class BotService:
-    def __init__(self, token: str, on_lead_completed: OnLeadCompleted):
+    def __init__(self, token: str, on_lead_completed: OnLeadCompleted, redis_url: str = ""):
         self.bot = Bot(token=token)
-        self.dp = Dispatcher(storage=MemoryStorage())
+        if redis_url:
+            # общий FSM для нескольких воркеров/инстансов (нужен пакет redis)
+            from aiogram.fsm.storage.redis import RedisStorage
+
+            storage = RedisStorage.from_url(redis_url)
+        else:
+            storage = MemoryStorage()
+        self.dp = Dispatcher(storage=storage)
         self.on_lead_completed = on_lead_completed
+        self._tasks: Set[asyncio.Task] = set()
         self._register_handlers()
 
     def _register_handlers(self) -> None:
@@ -99,7 +139,7 @@ class BotService:
         @dp.message(LeadForm.email, F.text)
         async def got_email(m: Message, state: FSMContext):
             email = (m.text or "").strip()
-            if "@" not in email or "." not in email:
+            if len(email) > 254 or not _EMAIL_RE.fullmatch(email):
                 await m.answer("Похоже, email некорректный. Введи, пожалуйста, нормальный email:")
                 return
             await state.update_data(email=email)
@@ -109,7 +149,8 @@ class BotService:
         @dp.message(LeadForm.age, F.text)
         async def got_age(m: Message, state: FSMContext):
             age = (m.text or "").strip()
-            if not age.isdigit():
+            # ASCII digits only (isdigit alone accepts e.g. '٢٣'), at most 3 of them
+            if not (1 <= len(age) <= 3 and age.isascii() and age.isdigit()):
                 await m.answer("Возраст нужен числом 🙂 Введи только цифры:")
                 return
             await state.update_data(age=age)
@@ -118,25 +159,25 @@ class BotService:
 
         @dp.message(LeadForm.gender, F.text)
         async def got_gender(m: Message, state: FSMContext):
-            await state.update_data(gender=(m.text or "").strip())
+            await state.update_data(gender=_sanitize(m))
             await m.answer("4/7 — Страна:")
             await state.set_state(LeadForm.country)
 
         @dp.message(LeadForm.country, F.text)
         async def got_country(m: Message, state: FSMContext):
-            await state.update_data(country=(m.text or "").strip())
+            await state.update_data(country=_sanitize(m))
             await m.answer("5/7 — Язык общения (например RU или EN):")
             await state.set_state(LeadForm.language)
 
         @dp.message(LeadForm.language, F.text)
         async def got_language(m: Message, state: FSMContext):
-            await state.update_data(language=(m.text or "").strip())
+            await state.update_data(language=_sanitize(m))
             await m.answer("6/7 — Уровень английского (A1/A2/B1/B2/C1/C2):")
             await state.set_state(LeadForm.english_level)
 
         @dp.message(LeadForm.english_level, F.text)
         async def got_level(m: Message, state: FSMContext):
-            await state.update_data(english_level=(m.text or "").strip())
+            await state.update_data(english_level=_sanitize(m))
             await m.answer("7/7 — Опыт с Amazon (нет / немного / продаю / другое):")
             await state.set_state(LeadForm.amazon_experience)
 
@@ -162,7 +203,7 @@ class BotService:
                 country=data.get("country", ""),
                 language=data.get("language", ""),
                 english_level=data.get("english_level", ""),
-                amazon_experience=(m.text or "").strip(),
+                amazon_experience=_sanitize(m),
             )
 
             # Тяжёлая часть
@@ -191,17 +232,7 @@ class BotService:
                 text = build_help_login_text(email)
             else:
                 # общий вариант
-                course_link = os.getenv("SKILLSPACE_PUBLIC_COURSE_URL", "https://855f92.skillspace.ru/course/102877").strip()
-                text = (
-                    "🆘 Инструкция, если не пришло письмо или не получается зайти\n\n"
-                    "1) Переходим на skillspace.ru\n"
-                    "   🇺🇦 Если вы проживаете в Украине — вам может понадобиться Brave или VPN.\n"
-                    "   🌍 Если вы не проживаете в Украине — VPN не нужен.\n\n"
-                    f"2) Заходим по ссылке: {course_link}\n"
-                    "   Нажимаем «Забыли пароль» / «Проблемы со входом».\n"
-                    "   Указываем ту же почту, что вводили в боте.\n"
-                    "   Устанавливаем новый пароль — и всё готово ✅"
-                )
+                text = _HELP_LOGIN_GENERIC
 
             await cb.message.answer(text)
 
@@ -209,7 +240,50 @@ class BotService:
         await self.bot.delete_webhook(drop_pending_updates=True)
         await self.dp.start_polling(self.bot)
 
+    async def start_webhook(
+        self,
+        url: str,
+        secret_token: str,
+        max_connections: int = 40,
+        drop_pending_updates: bool = False,
+    ) -> bool:
+        # getWebhookInfo не отдаёт secret, поэтому короткий хэш секрета идёт в query:
+        # сменили секрет -> сменился URL -> вебхук перерегистрируется.
+        # Остальные воркеры/рестарты видят тот же вебхук и ничего не трогают,
+        # а накопившиеся апдейты не выбрасываются.
+        sig = hashlib.sha256(secret_token.encode()).hexdigest()[:12]
+        target = url + ("&" if "?" in url else "?") + "sig=" + sig
+
+        info = await self.bot.get_webhook_info()
+        if info.url == target and info.max_connections == max_connections:
+            return False
+
+        await self.bot.set_webhook(
+            target,
+            secret_token=secret_token,
+            max_connections=max_connections,
+            drop_pending_updates=drop_pending_updates,
+        )
+        return True
+
+    def feed_webhook_body(self, body: bytes) -> None:
+        # разбираем апдейт сразу, а обрабатываем в фоне: Telegram ждёт только 200
+        update = Update.model_validate_json(body, context={"bot": self.bot})
+        task = asyncio.create_task(self._process_update(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process_update(self, update: Update) -> None:
+        # как в polling: ошибка хендлера логируется с id апдейта, а не теряется в таске
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logger.exception("Cause exception while process update id=%d", update.update_id)
+
     async def stop(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.dp.storage.close()
         await self.bot.session.close()
 
     async def send_message(self, telegram_id: int, text: str) -> None: